@@ -1,59 +1,157 @@
 import os
 import sys
 import time
+import ssl
 import socket
 import threading
+from CommandRegistry import CommandRegistry, command, argument
+from Tracing import tracer, tagMessage, splitTag
 
 #General Configuration
 host = "localhost"
 port = 8080
 buffer_size = 1024
 server_address = (host, port)
-name = input("Enter Name: ")#os.getlogin()
+plugin_dir = None   # Directory of command plugins to load
+
+#Reconnect Configuration
+reconnect_delay = 1         # Seconds to wait after the first failed attempt, doubled after every failure
+reconnect_max_delay = 30
+reconnect_attempts = None   # None keeps trying until the server is back
+
+#TLS Configuration
+use_tls = False
+ca_file = None      # CA used to verify the server certificate (None = system CAs)
+cert_file = None    # Client certificate, required when the server enforces mutual auth
+key_file = None
+
+def createClientContext() -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=ca_file)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if cert_file:
+        context.load_cert_chain(cert_file, key_file)
+    return context
 
 class Client:
-    def __init__(self):
+    # Shared by the clients that use the configured TLS settings
+    context = None
+
+    def __init__(self, name, address=server_address, sslContext=None):
+        self.name = name
+        self.address = address
+        self.sslContext = sslContext
+        if self.sslContext is None and use_tls:
+            if Client.context is None:
+                Client.context = createClientContext()
+            self.sslContext = Client.context
+        # Kept between connections so that reconnects can resume the TLS session
+        self.session = None
+        self.connect()
+
+    def connect(self):
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect(server_address)
-        self.client.send(name.encode())
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sslContext is not None:
+            self.client = self.sslContext.wrap_socket(self.client, server_hostname=self.address[0], session=self.session)
+        self.client.connect(self.address)
+        self.client.sendall((self.name + "\n").encode())
+        self.buffer = b""
 
+    # Messages are newline terminated. Replies to a traced message carry the agent's stage timings
     def send(self, message: str) -> None:
-        self.client.send(message.encode())
+        trace = tracer.current()
+        if trace is not None:
+            trace.mark("send")
+            message = tagMessage(message, trace.traceId, trace.breakdown())
+        self.client.sendall((message + "\n").encode())
 
-    def receive(self) -> str:
-        data = self.client.recv(buffer_size)
-        return data.decode()
+    # Returns None once the server has closed the connection
+    def receive(self) -> str | None:
+        while b"\n" not in self.buffer:
+            data = self.client.recv(buffer_size)
+            if not data:
+                return None
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode()
 
     def close(self):
+        # Session tickets arrive after the handshake, so grab the session on the way out
+        if self.sslContext is not None and self.client.session is not None:
+            self.session = self.client.session
         self.client.close()
 
+    def reconnect(self):
+        self.close()
+        self.connect()
+
 class CommandModule:
-    def __init__(self):
-        self.client = Client()
-        self.cmds = {
-            "ping": self.ping,
-            "beep": self.beep,
-        }
-        while True:
-            cmd = self.client.receive()
-            if cmd.startswith("ping"):
-                self.ping(cmd)
-            if cmd.startswith("stop"):
-                break
+    def __init__(self, client: Client, reconnectDelay=None, maxReconnectDelay=None, reconnectAttempts=None):
+        self.client = client
+        self.running = True
+        self.reconnectDelay = reconnect_delay if reconnectDelay is None else reconnectDelay
+        self.maxReconnectDelay = reconnect_max_delay if maxReconnectDelay is None else maxReconnectDelay
+        self.reconnectAttempts = reconnect_attempts if reconnectAttempts is None else reconnectAttempts
+        self.cmds = CommandRegistry()
+        self.cmds.registerAll(self)
+        self.cmds.loadPlugins(plugin_dir, self)
+
+    def run(self):
+        while self.running:
+            try:
+                cmd = self.client.receive()
+            except OSError:
+                cmd = None
+            if cmd is None:
+                # Connection lost without a stop or kick, the server may be restarting
+                if not self.running or not self.reconnect():
+                    break
+                continue
+            traceId, _, cmd = splitTag(cmd)
+            if traceId is not None:
+                tracer.resume(traceId)
+            self.cmds.dispatch(cmd)
+            tracer.discard()
+
+    # Reconnects with exponential backoff, resuming the TLS session if there is one
+    def reconnect(self) -> bool:
+        delay = self.reconnectDelay
+        attempt = 0
+        while self.running and (self.reconnectAttempts is None or attempt < self.reconnectAttempts):
+            attempt += 1
+            try:
+                self.client.reconnect()
+                return True
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, self.maxReconnectDelay)
+        return False
 
     # This function has a potential bug as system time may be different on the client and server
-    def ping(self,cmd):
-        ping_pack = cmd.split(" ")
-        ping_pack.append(str(time.time()))
+    @command("ping")
+    @argument("stamps", nargs="*")
+    def ping(self, args):
+        ping_pack = ["ping", *args.stamps, str(time.time())]
         ping_pack = " ".join(ping_pack)
         self.client.send(ping_pack)
 
+    @command("beep")
     def beep(self):
         pass
 
+    @command("conntest")
+    def conntest(self):
+        pass
+
+    @command("stop", aliases=("kick",))
+    def stop(self):
+        self.running = False
+
     def close(self):
         self.client.close()
 
 if __name__ == "__main__":
-    cmd = CommandModule()
-    cmd.close()
\ No newline at end of file
+    name = input("Enter Name: ")#os.getlogin()
+    cmd = CommandModule(Client(name))
+    cmd.run()
+    cmd.close()
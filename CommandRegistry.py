@@ -0,0 +1,245 @@
+import os
+import sys
+import asyncio
+import inspect
+import argparse
+import importlib.util
+from Tracing import tracer
+
+
+class _ParseError(Exception):
+    """
+    Raised by ArgumentParser.error so that a command with invalid arguments is not run.
+    """
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    """
+    Custom argument parser that prints error messages to stderr instead of stdout.
+
+    Attributes:
+    - None
+    """
+
+    def error(self, message):
+        """
+        Prints an error message to stderr.
+
+        Args:
+        - message (str): The error message to print.
+
+        Raises:
+        - _ParseError: Always, instead of exiting like argparse does.
+        """
+        print(f"Error: {message}", file=sys.stderr)
+        # self.print_help(sys.stderr)
+        raise _ParseError(message)
+
+
+def command(name, aliases=(), help=""):
+    """
+    Marks a method as a command handler so that CommandRegistry.registerAll picks it up.
+
+    Args:
+    - name (str): The name of the command.
+    - aliases (tuple): Alternative names for the command.
+    - help (str): A one line description shown by the help command.
+    """
+    def decorator(func):
+        func.commandName = name
+        func.commandAliases = tuple(aliases)
+        func.commandHelp = help
+        return func
+    return decorator
+
+
+def argument(*flags, **kwargs):
+    """
+    Adds an argument to the schema of a command handler. Takes the same arguments as ArgumentParser.add_argument.
+    Must be placed below the command decorator.
+    """
+    def decorator(func):
+        # Decorators are applied bottom up, insert at the front to keep the declared order
+        func.commandArguments = [(flags, kwargs)] + getattr(func, "commandArguments", [])
+        return func
+    return decorator
+
+
+class Command:
+    """
+    A class that represents a registered command.
+
+    Attributes:
+    - name (str): The name of the command.
+    - handler (callable): The function that handles the command.
+    - parser (ArgumentParser | None): The parser for the arguments of the command, or None if it takes no arguments.
+    - help (str): A one line description of the command.
+    """
+
+    def __init__(self, name, handler, parser=None, help="") -> None:
+        self.name = name
+        self.handler = handler
+        self.parser = parser
+        self.help = help
+
+
+class CommandRegistry:
+    """
+    A class that maps command names to their handlers.
+
+    Argument parsers are built once at registration and lookups are a single dict access,
+    so dispatch cost does not depend on the number of registered commands.
+
+    Attributes:
+    - commands (dict): A mapping of command names and aliases to Command objects.
+    """
+
+    def __init__(self) -> None:
+        self.commands:dict[str, Command] = {}
+        self.loop:asyncio.AbstractEventLoop | None = None
+
+    def register(self, name, handler, arguments=(), aliases=(), help="") -> Command:
+        """
+        Registers a command.
+
+        Args:
+        - name (str): The name of the command.
+        - handler (callable): The function that handles the command. Receives the parsed arguments if the command has any. May be a coroutine function.
+        - arguments (list): A list of (flags, kwargs) tuples passed to ArgumentParser.add_argument.
+        - aliases (tuple): Alternative names for the command.
+        - help (str): A one line description of the command.
+
+        Returns:
+        - Command: The registered command.
+        """
+        # Keys are lowercase, keep the name in the same case so it can be used as a key
+        name = name.lower()
+        parser = None
+        if arguments:
+            parser = ArgumentParser(prog=name, description=help)
+            for flags, kwargs in arguments:
+                parser.add_argument(*flags, **kwargs)
+        cmd = Command(name, handler, parser, help)
+        for key in (name, *aliases):
+            self.commands[key.lower()] = cmd
+        return cmd
+
+    def registerAll(self, obj) -> None:
+        """
+        Registers every method of an object that is marked with the command decorator.
+
+        Args:
+        - obj (object): The object whose methods should be registered.
+        """
+        for attr in dir(type(obj)):
+            func = getattr(type(obj), attr, None)
+            if callable(func) and hasattr(func, "commandName"):
+                self.register(
+                    func.commandName,
+                    getattr(obj, attr),
+                    getattr(func, "commandArguments", ()),
+                    func.commandAliases,
+                    func.commandHelp,
+                )
+
+    def loadPlugins(self, directory, owner) -> list[str]:
+        """
+        Imports every module in a directory and calls its register(registry, owner) function.
+
+        Args:
+        - directory (str): The directory containing the plugin modules.
+        - owner (object): The object the plugins extend (the ServerManager or the CommandModule).
+
+        Returns:
+        - list[str]: The names of the loaded plugins.
+        """
+        loaded = []
+        if not directory or not os.path.isdir(directory):
+            return loaded
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".py") or filename.startswith("_"):
+                continue
+            name = filename[:-3]
+            spec = importlib.util.spec_from_file_location("plugin_" + name, os.path.join(directory, filename))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            if hasattr(module, "register"):
+                module.register(self, owner)
+                loaded.append(name)
+        return loaded
+
+    def get(self, name) -> Command | None:
+        """
+        Returns the command registered under the specified name or alias.
+
+        Args:
+        - name (str): The name of the command.
+
+        Returns:
+        - Command | None: The command, or None if no such command exists.
+        """
+        return self.commands.get(name.lower())
+
+    def names(self) -> list[str]:
+        """
+        Returns the names of all registered commands, without aliases.
+        """
+        return sorted({cmd.name for cmd in self.commands.values()})
+
+    def dispatch(self, line):
+        """
+        Looks up and runs a command.
+        If the line does not resolve to a command with valid arguments, the current trace is discarded
+        so that it does not end up in the trace statistics.
+
+        Args:
+        - line (str | list): The command line, or an already split list of tokens.
+
+        Returns:
+        - The return value of the handler, or None if the command is unknown or its arguments could not be parsed.
+        """
+        tokens = line.split() if isinstance(line, str) else line
+        if not tokens:
+            tracer.discard()
+            return None
+        cmd = self.get(tokens[0])
+        tracer.mark("lookup")
+        if cmd == None:
+            tracer.discard()
+            print(f"Error: unknown command '{tokens[0]}'", file=sys.stderr)
+            return None
+        if cmd.parser == None:
+            result = cmd.handler()
+        else:
+            try:
+                args = cmd.parser.parse_args(tokens[1:])
+            except (SystemExit, _ParseError):
+                # The error was already printed, -h/--help prints the usage and tries to exit
+                tracer.discard()
+                return None
+            tracer.mark("parse")
+            result = cmd.handler(args)
+        if inspect.isawaitable(result):
+            result = self.runAsync(result)
+        return result
+
+    def runAsync(self, coro):
+        """
+        Runs a coroutine returned by an async handler to completion on the registry's event loop.
+
+        Args:
+        - coro (coroutine): The coroutine to run.
+
+        Returns:
+        - The result of the coroutine.
+        """
+        if self.loop == None or self.loop.is_closed():
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coro)
+
+    def printHelp(self) -> None:
+        """
+        Prints the registered commands and their descriptions.
+        """
+        for name in self.names():
+            print("{:12}{}".format(name, self.get(name).help))
@@ -1,10 +1,14 @@
 import os
-import sys
+import ssl
 import time
 import socket
 import colorama
 import argparse
 import threading
+from concurrent.futures import ThreadPoolExecutor
+# ArgumentParser is re-exported for code that still imports it from Server
+from CommandRegistry import CommandRegistry, ArgumentParser, command, argument
+from Tracing import tracer, tagMessage, splitTag, percentile
 
 class Logger:
     """
@@ -57,6 +61,31 @@ class Logger:
 logger = Logger()
 
 
+def createServerContext(certfile, keyfile, cafile=None) -> ssl.SSLContext:
+    """
+    Creates the TLS context used by the server.
+
+    Session tickets and the server side session cache are left enabled so that
+    reconnecting agents can resume their previous session instead of doing a
+    full handshake.
+
+    Args:
+    - certfile (str): Path to the server certificate (PEM).
+    - keyfile (str): Path to the private key of the server certificate (PEM).
+    - cafile (str | None): CA bundle used to verify agent certificates. When given, agents must present a certificate (mutual auth).
+
+    Returns:
+    - ssl.SSLContext: The server side TLS context.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    if cafile:
+        context.load_verify_locations(cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
 class Client:
     """
     A class that represents a client.
@@ -66,6 +95,11 @@ class Client:
     - ip (str): The IP address of the client.
     - port (int): The port number of the client.
     - name (str): The name of the client.
+    - buffer (bytes): Received data that does not form a complete message yet.
+    - lastTested (float): The server clock time at which a connection test was last written to the client without error.
+      The client does not answer connection tests, so this does not prove that it is still processing messages.
+
+    Messages are terminated by a newline and may start with a trace tag (see Tracing.tagMessage).
     """
 
     def __init__(self, client, addr, name) -> None:
@@ -80,24 +114,41 @@ class Client:
         self.client = client
         self.ip, self.port = addr
         self.name = name
+        self.buffer = b""
+        self.lastTested = 0.0
 
-    def send(self, msg: str) -> None:
+    def send(self, msg: str, traceId: int | None = None) -> None:
         """
         Sends a message to the client.
 
         Args:
         - msg (str): The message to send.
+        - traceId (int | None): The id of the trace the message belongs to.
         """
-        self.client.send(msg.encode("utf-8"))
+        if traceId != None:
+            msg = tagMessage(msg, traceId)
+        self.client.sendall((msg + "\n").encode("utf-8"))
 
     def recv(self) -> str:
         """
         Receives a message from the client.
+        If the message carries the agent's timings for the current trace, they are added to the trace.
 
         Returns:
-        - str: The received message.
-        """
-        return self.client.recv(1024).decode("utf-8")
+        - str: The received message, or an empty string if the connection was closed.
+        """
+        while b"\n" not in self.buffer:
+            data = self.client.recv(1024)
+            if not data:
+                line, self.buffer = self.buffer, b""
+                return line.decode("utf-8")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        traceId, remote, msg = splitTag(line.decode("utf-8"))
+        trace = tracer.current()
+        if trace != None and traceId == trace.traceId:
+            trace.mark("recv", remote)
+        return msg
     
     def close(self) -> None:
         """
@@ -109,6 +160,7 @@ class Client:
         """
         Clears the receive buffer.
         """
+        self.buffer = b""
         try:
             self.client.settimeout(0.01)
             self.client.recv(1024)
@@ -129,19 +181,42 @@ class Server:
     - Thread (threading.Thread): The thread object used for accepting clients.
     - isServerRunning (bool): A flag indicating whether the server is running.
     - isThreadRunning (bool): A flag indicating whether the thread is running.
+    - sslContext (ssl.SSLContext | None): The TLS context, or None for plain TCP.
+    - handshakePool (ThreadPoolExecutor): The pool that performs TLS handshakes and reads client names.
+    - clock (callable): Returns the current time in seconds, used for heartbeats only.
+    - heartbeatInterval (float): The minimum time between two connection tests of the same client.
+    - registerTimeout (float): The time a new client has to complete the TLS handshake and send its name.
+
+    At most handshakeWorkers clients are registered at the same time. A client that connects and
+    stays silent holds a worker for up to registerTimeout seconds, so handshakeWorkers idle
+    connections delay new registrations by at most registerTimeout. Registration is bounded by socket
+    timeouts, so it always runs on real time and does not use clock.
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, sslContext:ssl.SSLContext | None = None, handshakeWorkers:int = 16,
+                 clock=time.monotonic, heartbeatInterval:float = 0, registerTimeout:float = 2):
         """
         Initializes the Server object.
 
         Args:
         - host (str): The IP address of the server.
-        - port (int): The port number of the server.
+        - port (int): The port number of the server. Use 0 to pick a free port.
+        - sslContext (ssl.SSLContext | None): The TLS context to wrap client connections with (see createServerContext).
+        - handshakeWorkers (int): The number of threads used to register new clients.
+        - clock (callable): Returns the current time in seconds for heartbeats. Tests can pass a fake clock.
+        - heartbeatInterval (float): Clients that passed a connection test less than this many seconds ago are not tested again. 0 tests every time.
+        - registerTimeout (float): The time in seconds a new client has to complete the TLS handshake and send its name, in total. Independent of the 5 second timeout used for commands.
         """
         self.host = host
         self.port = port
+        self.sslContext = sslContext
+        self.clock = clock
+        self.heartbeatInterval = heartbeatInterval
+        self.registerTimeout = registerTimeout
         self.clients:list[Client] = []
+        self.clientsLock = threading.Lock()
+        self.clientsChanged = threading.Condition(self.clientsLock)
+        self.handshakePool = ThreadPoolExecutor(max_workers=handshakeWorkers, thread_name_prefix="handshake")
         self.Thread = threading.Thread(target=self.acceptClients)
         self.isServerRunning = False
         self.isThreadRunning = False
@@ -150,13 +225,15 @@ class Server:
         """
         Starts the server.
         """
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if self.isServerRunning:
             logger.logError("Server Already Running")
             return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
-        self.sock.listen(16)
-        logger.logInfo("Server started on {}:{}".format(self.host, self.port))
+        self.port = self.sock.getsockname()[1]
+        self.sock.listen(socket.SOMAXCONN)
+        logger.logInfo("Server started on {}:{}{}".format(self.host, self.port, " (TLS)" if self.sslContext else ""))
         self.isServerRunning = True
         self.isThreadRunning = True
         self.Thread.start()
@@ -171,11 +248,25 @@ class Server:
             return
         logger.logInfo("Stopping server...")
         self.isServerRunning = False
+        try:
+            # Closing alone does not wake up a thread blocked in accept()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
+        self.handshakePool.shutdown(wait=False, cancel_futures=True)
+        if self.Thread.is_alive() and self.Thread is not threading.current_thread():
+            self.Thread.join(timeout=5)
+        self.isThreadRunning = self.Thread.is_alive()
+        with self.clientsLock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.close()
 
     def acceptClients(self) -> None:
         """
         Accepts clients.
+        The TLS handshake and the name exchange are handed off to the handshake pool so that slow clients do not hold up the accept loop.
         THIS FUNCTION SHOULD NOT BE CALLED DIRECTLY.
         """
         logger.logInfo("Waiting for clients...")
@@ -183,34 +274,93 @@ class Server:
             try:
                 if self.isServerRunning and self.isThreadRunning:
                     client, addr = self.sock.accept()
-                    #DISABLED TIMEOUT FOR DEBUGGING
-                    #ENABLE FOR PRODUCTION
-                    client.settimeout(5)
-                    try:
-                        name = client.recv(1024).decode("utf-8")
-                    except TimeoutError:
-                        client.send(b"Request Timed out")
-                        client.close()
-                        logger.logError("Client timed out with address {}".format(addr))
-                        continue
-                    except Exception as e:
-                        logger.logError(str(e))
-                        continue
-                    client = Client(client, addr, name)
-                    self.clients.append(client)
-                    # print("Client {} connected".format(addr))
-                    logger.logInfo("\nClient {}{} connected".format(name, addr))
                 else:
                     break
             except OSError as e:
                 # print("[ERROR] Server Not Running")
                 # logger.logError(str(e))
-                pass
+                continue
             except Exception as e:
                 # print("[ERROR] {}".format(e))
-                logger.logError(e)
+                logger.logError(str(e))
+                continue
+            # stopServer may have run while accept() was returning, the pool no longer takes work then
+            if not self.isServerRunning:
+                client.close()
+                break
+            try:
+                self.handshakePool.submit(self.registerClient, client, addr)
+            except RuntimeError as e:
+                client.close()
+                logger.logError("Could not register client with address {}: {}".format(addr, str(e)))
         # self.isThreadRunning = False
 
+    def registerClient(self, client:socket.socket, addr) -> None:
+        """
+        Performs the TLS handshake (if enabled), reads the client name and adds the client to the client list.
+        THIS FUNCTION SHOULD NOT BE CALLED DIRECTLY.
+
+        Args:
+        - client (socket): The accepted socket.
+        - addr (tuple): A tuple containing the IP address and port number of the client.
+        """
+        # One deadline for the handshake and the name, so a client cannot hold the worker longer by trickling bytes
+        deadline = time.monotonic() + self.registerTimeout
+        client.settimeout(self.registerTimeout)
+        # Commands are small writes that expect a reply, do not let Nagle hold them back
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sslContext != None:
+            try:
+                client = self.sslContext.wrap_socket(client, server_side=True)
+            except (ssl.SSLError, OSError) as e:
+                client.close()
+                logger.logError("TLS handshake failed with address {}: {}".format(addr, e))
+                return
+        try:
+            client.settimeout(max(deadline - time.monotonic(), 0.001))
+            name = client.recv(1024).decode("utf-8").strip()
+        except TimeoutError:
+            try:
+                client.sendall(b"Request Timed out")
+            except OSError:
+                pass
+            finally:
+                client.close()
+            logger.logError("Client timed out with address {}".format(addr))
+            return
+        except Exception as e:
+            client.close()
+            logger.logError(str(e))
+            return
+        client.settimeout(5)
+        client = Client(client, addr, name)
+        client.lastTested = self.clock()
+        with self.clientsChanged:
+            # stopServer may have already emptied the client list, nobody would close this client
+            registered = self.isServerRunning
+            if registered:
+                self.clients.append(client)
+                self.clientsChanged.notify_all()
+        if not registered:
+            client.close()
+            return
+        # print("Client {} connected".format(addr))
+        logger.logInfo("\nClient {}{} connected{}".format(name, addr, " (TLS resumed)" if getattr(client.client, "session_reused", False) else ""))
+
+    def waitForClients(self, count:int, timeout:float | None = None) -> bool:
+        """
+        Waits until at least the specified number of clients are connected.
+
+        Args:
+        - count (int): The number of clients to wait for.
+        - timeout (float | None): The maximum time to wait in seconds, or None to wait forever.
+
+        Returns:
+        - bool: True if the clients connected, False if the timeout expired.
+        """
+        with self.clientsChanged:
+            return self.clientsChanged.wait_for(lambda: len(self.clients) >= count, timeout)
+
     def getClientByIp(self, ip) -> Client | None:
         """
         Returns the client object with the specified IP address.
@@ -250,7 +400,10 @@ class Server:
         """
         self.refreshActiveClients()
         for client in self.clients:
-            client.send(msg)
+            try:
+                client.send(msg)
+            except OSError:
+                logger.logWarning("Failed to send to client {} ({}:{})".format(client.name, client.ip, client.port))
 
     def kickIp(self, ip) -> None:
         """
@@ -262,103 +415,72 @@ class Server:
         self.refreshActiveClients()
         client = self.getClientByIp(ip)
         if client != None:
-            client.send("kick")
-            client.client.close()
-            self.clients.remove(client)
+            self.kickClient(client)
+
+    def kickClient(self, client:Client) -> None:
+        """
+        Kicks the specified client from the server.
+
+        Args:
+        - client (Client): The client to kick.
+        """
+        with self.clientsLock:
+            tracer.mark("lock")
+            if client in self.clients:
+                self.clients.remove(client)
+        trace = tracer.current()
+        try:
+            client.send("kick", trace.traceId if trace != None else None)
+        except OSError:
+            pass
+        tracer.mark("send")
+        client.close()
 
     def refreshActiveClients(self) -> None:
         """
-        Refreshes the list of active clients by sending a ping message to each client and removing any that do not respond.
+        Refreshes the list of active clients by sending a connection test to each client and removing any whose connection fails.
+        Clients that were tested less than heartbeatInterval seconds ago are skipped, so frequent refreshes do not write to every client.
         """
-        for client in self.clients:
+        now = self.clock()
+        with self.clientsLock:
+            clients = list(self.clients)
+        for client in clients:
+            if now - client.lastTested < self.heartbeatInterval:
+                continue
             try:
                 client.send("conntest")
+                client.lastTested = now
             except:
-                self.clients.remove(client)
+                with self.clientsLock:
+                    if client in self.clients:
+                        self.clients.remove(client)
                 logger.logWarning(
                     "Client {} ({}:{}) disconnected".format(client.name, client.ip, client.port)
                 )
+        tracer.mark("refresh")
 
 
 
-class ArgumentParser(argparse.ArgumentParser):
-    """
-    Custom argument parser that prints error messages to stderr instead of stdout.
-
-    Attributes:
-    - None
-    """
-
-    def error(self, message):
-        """
-        Prints an error message to stderr.
-
-        Args:
-        - message (str): The error message to print.
-
-        Returns:
-        - None
-        """
-        print(f"Error: {message}", file=sys.stderr)
-        # self.print_help(sys.stderr)
-        pass
-
-
 class ServerManager:
-    def __init__(self, ip, port) -> None:
-        self.server = Server(ip, port)
-        self.cmds = {
-            "start": self.server.startServer,
-            "stop": self.server.stopServer,
-            "list": self.listClients,
-            "stat": self.stat,
-            "ping": self.ping,
-            "resolve": self.resolve,
-            "kick": self.kick,
-            "cls": lambda: os.system("cls"),
-            "clear": lambda: os.system("cls"),
-            "exit": self.exitServer,
-            "beep": self.beep,
-            "refresh": self.refresh,
-            "help": None,
-        }
+    def __init__(self, ip, port, sslContext:ssl.SSLContext | None = None, pluginDir=None,
+                 handshakeWorkers:int = 16, registerTimeout:float = 2, heartbeatInterval:float = 0) -> None:
+        self.server = Server(ip, port, sslContext, handshakeWorkers,
+                             heartbeatInterval=heartbeatInterval, registerTimeout=registerTimeout)
+        self.cmds = CommandRegistry()
+        self.cmds.register("start", self.server.startServer, help="Start the server")
+        self.cmds.register("stop", self.server.stopServer, help="Stop the server")
+        self.cmds.register("cls", lambda: os.system("cls"), aliases=("clear",), help="Clear the screen")
+        self.cmds.registerAll(self)
+        for plugin in self.cmds.loadPlugins(pluginDir, self):
+            logger.logInfo("Loaded plugin " + plugin)
 
     def cmdExec(self) -> None:
         try:
-            parser = ArgumentParser(description="Server Manager",add_help=False)
-            parser.add_argument(
-                "command",
-                type=str.lower,
-                help="Command to execute",
-                choices=self.cmds.keys(),
-            )
             while True:
                 cmd = input(colorama.Fore.GREEN + ">>> " + colorama.Fore.WHITE)
-                args = parser.parse_known_args(cmd.split())
-                if args[0].command == "start":
-                    self.cmds[args[0].command]()
-                elif args[0].command == "stop":
-                    self.cmds[args[0].command]()
-                elif args[0].command == "list":
-                    self.cmds[args[0].command]()
-                elif args[0].command == "stat":
-                    self.cmds[args[0].command]()
-                elif args[0].command == "ping":
-                    self.cmds[args[0].command](args[1])
-                elif args[0].command == "resolve":
-                    self.cmds[args[0].command](args[1])
-                elif args[0].command == "kick":
-                    self.cmds[args[0].command](args[1])
-                elif args[0].command == "cls" or args[0].command == "clear":
-                    self.cmds[args[0].command]()
-                elif args[0].command == "exit":
-                    self.cmds[args[0].command]()
-                elif args[0].command == "beep":
-                    self.cmds[args[0].command](args[1])
-                elif args[0].command == "refresh":
-                    self.cmds[args[0].command]()
-                elif args[0].command == "help":
-                    parser.print_help()
+                tracer.start(cmd)
+                self.cmds.dispatch(cmd)
+                tracer.finish()
 
         except KeyboardInterrupt:
             self.server.stopServer()
@@ -366,46 +488,46 @@ class ServerManager:
             self.server.stopServer()
             logger.logError(str(e))
 
+    @command("help", help="Show this help")
+    def help(self):
+        self.cmds.printHelp()
+
+    @command("refresh", help="Drop clients that are no longer connected")
     def refresh(self):
         self.server.refreshActiveClients()
 
-    def beep(self,cmd):
-        parser = ArgumentParser(description="Beep")
-        parser.add_argument(
-            "-i", "--ip", type=str, help="IP address to beep", default=None
-        )
-        parser.add_argument(
-            "-n", "--name", type=str, help="Name of client to beep", default=None
-        )
-        parser.add_argument(
-            "-a","--all",action="store_true",help="Beep all clients",default=False
-        )
-
-    def kick(self, cmd):
-        parser = ArgumentParser(description="Kick client")
-        parser.add_argument(
-            "-i", "--ip", type=str, help="IP address to kick", default=None
-        )
-        parser.add_argument(
-            "-n", "--name", type=str, help="Name of client to kick", default=None
-        )
-        args = parser.parse_args(cmd)
+    @command("beep", help="Beep clients")
+    @argument("-i", "--ip", type=str, help="IP address to beep", default=None)
+    @argument("-n", "--name", type=str, help="Name of client to beep", default=None)
+    @argument("-a", "--all", action="store_true", help="Beep all clients", default=False)
+    def beep(self, args):
+        pass
+
+    @command("kick", help="Kick a client")
+    @argument("-i", "--ip", type=str, help="IP address to kick", default=None)
+    @argument("-n", "--name", type=str, help="Name of client to kick", default=None)
+    def kick(self, args):
         if args.ip:
-            print("kick ip", args.ip)
+            client = self.server.getClientByIp(args.ip)
+            if client != None:
+                self.server.kickClient(client)
+                print("kick ip", args.ip)
+            else:
+                logger.logWarning("Client not found")
         elif args.name:
-            print("kick name", args.name)
+            client = self.server.getClientByName(args.name)
+            if client != None:
+                self.server.kickClient(client)
+                print("kick name", args.name)
+            else:
+                logger.logWarning("Client not found")
         else:
-            parser.print_help()
-
-    def resolve(self, cmd):
-        parser = ArgumentParser(description="Resolve IP address")
-        parser.add_argument(
-            "-i", "--ip", type=str, help="IP address to resolve", default=None
-        )
-        parser.add_argument(
-            "-n", "--name", type=str, help="Name to resolve", default=None
-        )
-        args = parser.parse_args(cmd)
+            self.cmds.get("kick").parser.print_help()
+
+    @command("resolve", help="Resolve a client name or IP address")
+    @argument("-i", "--ip", type=str, help="IP address to resolve", default=None)
+    @argument("-n", "--name", type=str, help="Name to resolve", default=None)
+    def resolve(self, args):
         if args.ip:
             client = self.server.getClientByIp(args.ip)
             if client != None:
@@ -419,14 +541,16 @@ class ServerManager:
             else:
                 print("resolve name", args.name, "=>", "None")
         else:
-            parser.print_help()
+            self.cmds.get("resolve").parser.print_help()
 
+    @command("exit", help="Stop the server and exit")
     def exitServer(self):
         if self.server.isServerRunning:
             self.server.stopServer()
         logger.logInfo("Exiting...")
         exit(0)
 
+    @command("stat", help="Show the server status")
     def stat(self):
         print("Server Status")
         print("Server Running:", self.server.isServerRunning)
@@ -440,65 +564,82 @@ class ServerManager:
             logger.logWarning("Internal Error might have occured in Server/Thread or there might be a bug in the code")
             logger.logWarning("Please report this issue to the developer")
 
-    def ping(self, cmd):
-        parser = ArgumentParser(description="Ping utility")
-        parser.add_argument(
-            "-a", "--all", action="store_true", help="Ping All Clients", default=False
-        )
-        parser.add_argument(
-            "-i", "--ip", type=str, help="IP address to ping", default=None
-        )
-        parser.add_argument(
-            "-n", "--name", type=str, help="Name of client to ping", default=None
-        )
-
-        args = parser.parse_args(cmd)
+    @command("ping", help="Measure the round trip time to clients")
+    @argument("-a", "--all", action="store_true", help="Ping All Clients", default=False)
+    @argument("-i", "--ip", type=str, help="IP address to ping", default=None)
+    @argument("-n", "--name", type=str, help="Name of client to ping", default=None)
+    def ping(self, args):
         if args.all:
             for client in self.server.clients:
-                try:
-                    print("Pinging", client.name, "["+client.ip+"]")
-                    client.send("ping"+" "+str(time.time()))
-                    reply = client.recv().split()
-                    send_time = round((float(reply[2]) - float(reply[1]))*1000,2)
-                    recv_time = round((time.time() - float(reply[2]))*1000,2)
-                    print("Server -> Client:", send_time,"ms")
-                    print("Client -> Server:", recv_time,"ms")
-                    print("Client -> Server -> Client:", send_time + recv_time,"ms\n")
-                except:
-                    logger.logWarning("Ping failed for client "+client.name)
+                self.pingClient(client)
         elif args.ip:
             client = self.server.getClientByIp(args.ip)
             if client != None:
-                try:
-                    print("Pinging", client.name, "["+client.ip+"]")
-                    client.send("ping"+" "+str(time.time()))
-                    reply = client.recv().split()
-                    send_time = round((float(reply[2]) - float(reply[1]))*1000,2)
-                    recv_time = round((time.time() - float(reply[2]))*1000,2)
-                    print("Server -> Client:", send_time,"ms")
-                    print("Client -> Server:", recv_time,"ms")
-                    print("Client -> Server -> Client:", send_time + recv_time,"ms\n")
-                except:
-                    logger.logWarning("Ping failed for client "+client.name)
+                self.pingClient(client)
             else:
                 logger.logWarning("Client not found")
         elif args.name:
             client = self.server.getClientByName(args.name)
             if client != None:
-                try:
-                    print("Pinging", client.name, "["+client.ip+"]")
-                    client.send("ping"+" "+str(time.time()))
-                    reply = client.recv().split()
-                    send_time = round((float(reply[2]) - float(reply[1]))*1000,2)
-                    recv_time = round((time.time() - float(reply[2]))*1000,2)
-                    print("Server -> Client:", send_time,"ms")
-                    print("Client -> Server:", recv_time,"ms")
-                    print("Client -> Server -> Client:", send_time + recv_time,"ms\n")
-                except:
-                    logger.logWarning("Ping failed for client "+client.name)
+                self.pingClient(client)
             else:
                 logger.logWarning("Client not found")
 
+    def pingClient(self, client:Client):
+        try:
+            print("Pinging", client.name, "["+client.ip+"]")
+            trace = tracer.current()
+            # Mark before writing: the agent can answer before sendall returns, and its time must fit inside the recv stage
+            tracer.mark("send")
+            client.send("ping"+" "+str(time.time()), trace.traceId if trace != None else None)
+            reply = client.recv().split()
+            send_time = round((float(reply[2]) - float(reply[1]))*1000,2)
+            recv_time = round((time.time() - float(reply[2]))*1000,2)
+            print("Server -> Client:", send_time,"ms")
+            print("Client -> Server:", recv_time,"ms")
+            print("Client -> Server -> Client:", send_time + recv_time,"ms\n")
+        except:
+            logger.logWarning("Ping failed for client "+client.name)
+
+    @command("trace", help="Trace command latency per stage")
+    @argument("action", nargs="?", choices=["on", "off", "show", "clear"], default="show", help="Enable, disable, show or clear traces")
+    @argument("-c", "--command", type=str, help="Only show traces of this command", default=None)
+    @argument("-l", "--last", type=int, help="Also show the breakdown of the last N traces", default=0)
+    def trace(self, args):
+        # Keep the trace command itself out of the results
+        tracer.discard()
+        if args.action == "on":
+            tracer.enabled = True
+            logger.logInfo("Tracing enabled")
+        elif args.action == "off":
+            tracer.enabled = False
+            logger.logInfo("Tracing disabled")
+        elif args.action == "clear":
+            tracer.clear()
+            logger.logInfo("Traces cleared")
+        else:
+            self.showTraces(args.command, args.last)
+
+    def showTraces(self, cmd=None, last=0):
+        stages = tracer.summary(cmd)
+        if not stages:
+            logger.logInfo("No traces recorded" + ("" if tracer.enabled else ", use 'trace on' to enable tracing"))
+            return
+        print("{:16}{:>8}{:>10}{:>10}{:>10}{:>10}".format("Stage", "Count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for stage, durations in stages.items():
+            print("{:16}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+                stage, len(durations),
+                percentile(durations, 50) / 1e6, percentile(durations, 90) / 1e6,
+                percentile(durations, 99) / 1e6, durations[-1] / 1e6,
+            ))
+        if last:
+            traces = [trace for trace in tracer.traces if not cmd or trace.command == cmd][-last:]
+            for trace in traces:
+                print("\n#{} {} ({:.3f} ms)".format(trace.traceId, trace.command, trace.total() / 1e6))
+                for stage, ns in trace.breakdown():
+                    print("  {:16}{:>10.3f} ms".format(stage, ns / 1e6))
+
+    @command("list", help="List connected clients")
     def listClients(self):
         print("{:32}{:16}{:6}".format("Name", "IP Address", "Port"))
         for client in self.server.clients:
@@ -507,5 +648,20 @@ class ServerManager:
 
 if __name__ == "__main__":
     # logger.logWarning("Please support StackOverflow by visiting https://stackoverflow.com/ and asking/answering questions")
-    server = ServerManager("127.0.0.1", 8080)
+    options = argparse.ArgumentParser(description="Server Manager")
+    options.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    options.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    options.add_argument("--certfile", type=str, default=None, help="Server certificate (enables TLS)")
+    options.add_argument("--keyfile", type=str, default=None, help="Private key of the server certificate")
+    options.add_argument("--cafile", type=str, default=None, help="CA used to verify client certificates (enables mutual auth)")
+    options.add_argument("--plugins", type=str, default=None, help="Directory of command plugins to load")
+    options.add_argument("--handshake-workers", type=int, default=16, help="Number of clients that can be registering at the same time")
+    options.add_argument("--register-timeout", type=float, default=2, help="Seconds a new client has to finish the TLS handshake and send its name")
+    options.add_argument("--heartbeat-interval", type=float, default=0, help="Seconds before refresh tests the same client again (0 tests every time)")
+    options = options.parse_args()
+    sslContext = None
+    if options.certfile:
+        sslContext = createServerContext(options.certfile, options.keyfile, options.cafile)
+    server = ServerManager(options.host, options.port, sslContext, options.plugins,
+                           options.handshake_workers, options.register_timeout, options.heartbeat_interval)
     server.cmdExec()
\ No newline at end of file
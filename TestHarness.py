@@ -0,0 +1,226 @@
+import ssl
+import socket
+import threading
+import unittest
+from Server import Server
+from Client import Client as AgentClient, CommandModule
+from Tracing import splitTag
+
+
+class FakeClock:
+    """
+    A clock for the server that only moves when the test advances it.
+
+    Attributes:
+    - now (float): The current time in seconds.
+    """
+
+    def __init__(self, now:float = 0.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds:float) -> None:
+        """
+        Moves the clock forward.
+
+        Args:
+        - seconds (float): The number of seconds to advance.
+        """
+        self.now += seconds
+
+
+class FakeAgent:
+    """
+    An in-process agent that speaks the same protocol as Client.py but only does what the test tells it to.
+
+    Messages are read on demand by the test, so an agent costs one socket and no thread.
+    Use ServerTestCase.startAgent to run the real agent instead.
+
+    Attributes:
+    - name (str): The name sent to the server.
+    - sock (socket): The connection to the server.
+    """
+
+    def __init__(self, port:int, name:str, sslContext:ssl.SSLContext | None = None,
+                 host:str = "127.0.0.1", timeout:float = 5, session:ssl.SSLSession | None = None) -> None:
+        """
+        Connects to the server and sends the agent name.
+
+        Args:
+        - port (int): The port of the server.
+        - name (str): The name of the agent.
+        - sslContext (ssl.SSLContext | None): The client side TLS context, or None for plain TCP.
+        - host (str): The address of the server.
+        - timeout (float): The socket timeout in seconds.
+        - session (ssl.SSLSession | None): A TLS session to resume.
+        """
+        self.name = name
+        self.buffer = b""
+        sock = socket.create_connection((host, port), timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if sslContext != None:
+            sock = sslContext.wrap_socket(sock, server_hostname="localhost", session=session)
+        self.sock = sock
+        self.send(name)
+
+    def send(self, msg:str) -> None:
+        """
+        Sends a message to the server.
+        """
+        self.sock.sendall((msg + "\n").encode("utf-8"))
+
+    def recvLine(self) -> str | None:
+        """
+        Receives the next message as sent by the server, including its trace tag.
+
+        Returns:
+        - str | None: The message, or None if the server closed the connection.
+        """
+        while b"\n" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode("utf-8")
+
+    def recv(self, skip=("conntest",)) -> str | None:
+        """
+        Receives the next message, without its trace tag, skipping connection tests.
+
+        Args:
+        - skip (tuple): Messages to ignore.
+
+        Returns:
+        - str | None: The message, or None if the server closed the connection.
+        """
+        while True:
+            line = self.recvLine()
+            if line == None:
+                return None
+            _, _, msg = splitTag(line)
+            if msg not in skip:
+                return msg
+
+    def close(self) -> None:
+        """
+        Closes the connection.
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    A test case that runs a Server on an ephemeral port with a fake clock.
+
+    The server and every agent created through connect() or startAgent() are stopped and closed after each test.
+    The fake clock only drives heartbeats. Registration timeouts are socket timeouts and run on real time,
+    so tests of them should use a short registerTimeout.
+
+    Attributes:
+    - server (Server): The server under test, started in setUp.
+    - clock (FakeClock): The clock used by the server.
+    """
+
+    serverOptions:dict = {}
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.agents:list[FakeAgent] = []
+        self.realAgents:list[tuple[CommandModule, threading.Thread]] = []
+        self.server = None
+        self.addCleanup(self.stopAgents)
+        self.addCleanup(self.closeAgents)
+        self.addCleanup(self.stopServer)
+        self.startServer(**self.serverOptions)
+
+    def startServer(self, **options) -> Server:
+        """
+        Starts a new server under test, stopping the current one. Keyword arguments are passed to Server.
+
+        Returns:
+        - Server: The started server.
+        """
+        if self.server != None:
+            self.stopServer()
+        options.setdefault("clock", self.clock)
+        self.server = Server("127.0.0.1", 0, **options)
+        self.server.Thread.daemon = True
+        self.server.startServer()
+        return self.server
+
+    def stopServer(self) -> None:
+        if self.server.isServerRunning:
+            self.server.stopServer()
+
+    def closeAgents(self) -> None:
+        for agent in self.agents:
+            agent.close()
+
+    def stopAgents(self) -> None:
+        for agent, thread in self.realAgents:
+            agent.running = False
+            try:
+                agent.client.client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            thread.join(timeout=5)
+            agent.close()
+
+    def startAgent(self, name:str = "agent", count:int | None = None, sslContext:ssl.SSLContext | None = None, **options) -> CommandModule:
+        """
+        Runs the agent from Client.py in a background thread and waits until the server has registered it.
+
+        Args:
+        - name (str): The name of the agent.
+        - count (int | None): The number of clients the server should have once the agent is registered. Defaults to the number of agents connected so far.
+        - sslContext (ssl.SSLContext | None): The client side TLS context, or None for plain TCP.
+        - options: Passed to CommandModule.
+
+        Returns:
+        - CommandModule: The running agent.
+        """
+        agent = CommandModule(AgentClient(name, ("127.0.0.1", self.server.port), sslContext), **options)
+        thread = threading.Thread(target=agent.run, daemon=True)
+        thread.start()
+        self.realAgents.append((agent, thread))
+        if count == None:
+            count = len(self.agents) + len(self.realAgents)
+        self.assertTrue(self.server.waitForClients(count, timeout=5), "agent {} was not registered".format(name))
+        return agent
+
+    def dropClient(self, index:int = 0) -> None:
+        """
+        Closes the connection to a client without telling it, as if the network failed.
+
+        Args:
+        - index (int): The position of the client in the server's client list.
+        """
+        with self.server.clientsLock:
+            client = self.server.clients.pop(index)
+        client.close()
+
+    def connect(self, name:str = "agent", count:int | None = None, **options) -> FakeAgent:
+        """
+        Connects an agent and waits until the server has registered it.
+
+        Args:
+        - name (str): The name of the agent.
+        - count (int | None): The number of clients the server should have once the agent is registered. Defaults to the number of agents connected so far.
+        - options: Passed to FakeAgent.
+
+        Returns:
+        - FakeAgent: The connected agent.
+        """
+        agent = FakeAgent(self.server.port, name, **options)
+        self.agents.append(agent)
+        if count == None:
+            count = len(self.agents) + len(self.realAgents)
+        self.assertTrue(self.server.waitForClients(count, timeout=5), "agent {} was not registered".format(name))
+        return agent
@@ -0,0 +1,229 @@
+import math
+import time
+import itertools
+import threading
+from collections import deque
+
+
+def tagMessage(msg, traceId, remote=()) -> str:
+    """
+    Prefixes a message with its trace tag.
+
+    The tag has the form "#<traceId>" or, for agent replies, "#<traceId>:<stage>=<ns>,<stage>=<ns>"
+    where each stage carries the time the agent spent in it.
+
+    Args:
+    - msg (str): The message to tag.
+    - traceId (int): The id of the trace.
+    - remote (list): A list of (stage, duration in ns) tuples measured by the agent.
+
+    Returns:
+    - str: The tagged message.
+    """
+    tag = "#" + str(traceId)
+    if remote:
+        tag += ":" + ",".join("{}={}".format(stage, ns) for stage, ns in remote)
+    return tag + " " + msg
+
+
+def splitTag(line):
+    """
+    Splits the trace tag from a message.
+
+    Args:
+    - line (str): The received message.
+
+    Returns:
+    - tuple: (traceId, remote, msg). traceId is None and remote is empty if the message is not tagged.
+    """
+    if not line.startswith("#"):
+        return None, [], line
+    tag, _, msg = line.partition(" ")
+    traceId, _, stages = tag[1:].partition(":")
+    remote = []
+    if stages:
+        for stage in stages.split(","):
+            name, _, ns = stage.partition("=")
+            remote.append((name, int(ns)))
+    return int(traceId), remote, msg
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return 0
+    index = max(0, min(len(values), math.ceil(pct / 100 * len(values))) - 1)
+    return values[index]
+
+
+class Trace:
+    """
+    A class that represents the trace of a single command.
+
+    Attributes:
+    - traceId (int): The id carried by the messages of the command.
+    - command (str): The name of the traced command.
+    - stages (list): A list of (stage, monotonic timestamp in ns, remote) tuples, in order.
+      remote holds the (stage, duration in ns) tuples the agent reported with the reply that ended the stage.
+    """
+
+    def __init__(self, traceId, command, stage) -> None:
+        self.traceId = traceId
+        self.command = command
+        self.stages = [(stage, time.monotonic_ns(), [])]
+
+    def mark(self, stage, remote=()) -> None:
+        """
+        Records the time at which a stage ended.
+
+        Args:
+        - stage (str): The name of the stage.
+        - remote (list): The (stage, duration in ns) tuples reported by the agent in the reply that ended the stage.
+        """
+        self.stages.append((stage, time.monotonic_ns(), list(remote)))
+
+    def breakdown(self) -> list[tuple[str, int]]:
+        """
+        Returns the time spent in each stage.
+
+        The agent's own stages are reported as "agent_<stage>" right before the stage in which its
+        reply was received, and are subtracted from that stage only so that it counts the network time.
+        A command that waits for several replies gets one set of agent stages per reply.
+
+        Returns:
+        - list: A list of (stage, duration in ns) tuples.
+        """
+        result = []
+        for (_, start, _), (stage, end, remote) in zip(self.stages, self.stages[1:]):
+            duration = end - start
+            for remoteStage, ns in remote:
+                result.append(("agent_" + remoteStage, ns))
+                duration -= ns
+            result.append((stage, duration))
+        return result
+
+    def total(self) -> int:
+        """
+        Returns the time between the first and the last stage in ns.
+        """
+        return self.stages[-1][1] - self.stages[0][1]
+
+
+class Tracer:
+    """
+    A class that records command traces into a ring buffer.
+
+    The trace being recorded is kept per thread, so the code on the path of a command only has to
+    call mark(). mark() does nothing when no trace is active, which keeps the cost of disabled tracing
+    to a thread local lookup.
+
+    Attributes:
+    - enabled (bool): A flag indicating whether new commands are traced.
+    - traces (deque): The most recent finished traces.
+    """
+
+    def __init__(self, capacity=1024) -> None:
+        self.enabled = False
+        self.traces:deque[Trace] = deque(maxlen=capacity)
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+
+    def start(self, command) -> Trace | None:
+        """
+        Starts tracing a command on the current thread.
+
+        Args:
+        - command (str): The command line being executed.
+
+        Returns:
+        - Trace | None: The new trace, or None if tracing is disabled.
+        """
+        if not self.enabled:
+            return None
+        tokens = command.split()
+        trace = Trace(next(self.ids), tokens[0].lower() if tokens else "", "input")
+        self.local.trace = trace
+        return trace
+
+    def resume(self, traceId) -> Trace:
+        """
+        Continues a trace started by the other side, on the current thread.
+
+        Args:
+        - traceId (int): The id carried by the received message.
+
+        Returns:
+        - Trace: The trace of the received message.
+        """
+        trace = Trace(traceId, "", "receive")
+        self.local.trace = trace
+        return trace
+
+    def current(self) -> Trace | None:
+        """
+        Returns the trace being recorded on the current thread.
+        """
+        return getattr(self.local, "trace", None)
+
+    def mark(self, stage, remote=()) -> None:
+        """
+        Records the end of a stage on the current trace, if any.
+
+        Args:
+        - stage (str): The name of the stage.
+        - remote (list): The (stage, duration in ns) tuples reported by the agent, if the stage ended with its reply.
+        """
+        trace = getattr(self.local, "trace", None)
+        if trace != None:
+            trace.mark(stage, remote)
+
+    def finish(self) -> None:
+        """
+        Ends the current trace and stores it in the ring buffer.
+        """
+        trace = self.current()
+        if trace != None:
+            trace.mark("done")
+            self.traces.append(trace)
+            self.local.trace = None
+
+    def discard(self) -> None:
+        """
+        Ends the current trace without storing it.
+        """
+        self.local.trace = None
+
+    def clear(self) -> None:
+        """
+        Removes all stored traces.
+        """
+        self.traces.clear()
+
+    def summary(self, command=None) -> dict[str, list[int]]:
+        """
+        Collects the duration of every stage over the stored traces.
+
+        Args:
+        - command (str | None): Only include traces of this command.
+
+        Returns:
+        - dict: A mapping of stage names to the sorted durations in ns, with "total" holding the whole command.
+        """
+        stages:dict[str, list[int]] = {}
+        for trace in list(self.traces):
+            if command and trace.command != command:
+                continue
+            perTrace:dict[str, int] = {}
+            for stage, ns in trace.breakdown():
+                perTrace[stage] = perTrace.get(stage, 0) + ns
+            perTrace["total"] = trace.total()
+            for stage, ns in perTrace.items():
+                stages.setdefault(stage, []).append(ns)
+        for durations in stages.values():
+            durations.sort()
+        return stages
+
+
+tracer = Tracer()
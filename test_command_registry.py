@@ -0,0 +1,142 @@
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+from io import StringIO
+from CommandRegistry import CommandRegistry, command, argument
+from Tracing import tracer
+
+
+class Handlers:
+    def __init__(self):
+        self.calls = []
+
+    @command("ping", aliases=("p",), help="Ping")
+    @argument("-i", "--ip", type=str, default=None)
+    @argument("-a", "--all", action="store_true", default=False)
+    def ping(self, args):
+        self.calls.append(("ping", args.ip, args.all))
+        return "pong"
+
+    @command("refresh")
+    def refresh(self):
+        self.calls.append(("refresh",))
+
+    @command("wait")
+    async def wait(self):
+        return "done"
+
+    def notACommand(self):
+        pass
+
+
+class TestCommandRegistry(unittest.TestCase):
+    def setUp(self):
+        self.handlers = Handlers()
+        self.registry = CommandRegistry()
+        self.registry.registerAll(self.handlers)
+        self.stderr = StringIO()
+        sys.stderr = self.stderr
+
+    def tearDown(self):
+        sys.stderr = sys.__stderr__
+
+    def test_register_all(self):
+        self.assertEqual(self.registry.names(), ["ping", "refresh", "wait"])
+        self.assertIsNone(self.registry.get("notACommand"))
+
+    def test_dispatch_parses_arguments(self):
+        self.assertEqual(self.registry.dispatch("ping -i 10.0.0.1 -a"), "pong")
+        self.assertEqual(self.handlers.calls, [("ping", "10.0.0.1", True)])
+
+    def test_dispatch_without_arguments(self):
+        self.registry.dispatch(["refresh"])
+        self.assertEqual(self.handlers.calls, [("refresh",)])
+
+    def test_aliases_and_case(self):
+        self.registry.dispatch("P")
+        self.registry.dispatch("PING --ip 1.2.3.4")
+        self.assertEqual(self.handlers.calls, [("ping", None, False), ("ping", "1.2.3.4", False)])
+        self.assertIs(self.registry.get("p"), self.registry.get("ping"))
+
+    def test_mixed_case_name(self):
+        self.registry.register("Uptime", lambda: "up", help="Show uptime")
+        self.assertEqual(self.registry.get("UPTIME").name, "uptime")
+        self.assertEqual(self.registry.dispatch("Uptime"), "up")
+        sys.stdout = StringIO()
+        try:
+            self.registry.printHelp()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertIn("Show uptime", output)
+
+    def test_parser_built_once(self):
+        parser = self.registry.get("ping").parser
+        self.registry.dispatch("ping -a")
+        self.assertIs(self.registry.get("ping").parser, parser)
+        self.assertIsNone(self.registry.get("refresh").parser)
+
+    def test_unknown_command(self):
+        self.assertIsNone(self.registry.dispatch("bogus"))
+        self.assertIn("unknown command 'bogus'", self.stderr.getvalue())
+        self.assertIsNone(self.registry.dispatch("   "))
+
+    def test_invalid_arguments_do_not_run_handler(self):
+        self.registry.register("mode", lambda args: self.handlers.calls.append(args.action),
+                               [(("action",), {"choices": ["on", "off"]})])
+        self.assertIsNone(self.registry.dispatch("mode of"))
+        self.assertIsNone(self.registry.dispatch("ping --bogus"))
+        self.assertIsNone(self.registry.dispatch("ping -i"))
+        self.assertEqual(self.handlers.calls, [])
+        self.assertEqual(self.stderr.getvalue().count("Error:"), 3)
+        self.registry.dispatch("mode off")
+        self.assertEqual(self.handlers.calls, ["off"])
+
+    def test_failed_dispatch_discards_trace(self):
+        tracer.enabled = True
+        self.addCleanup(setattr, tracer, "enabled", False)
+        self.addCleanup(tracer.clear)
+        for line in ("", "bogus", "ping --bogus", "ping -a"):
+            tracer.start(line)
+            self.registry.dispatch(line)
+            tracer.finish()
+        self.assertEqual([trace.command for trace in tracer.traces], ["ping"])
+
+    def test_help_flag_does_not_exit(self):
+        sys.stdout = StringIO()
+        try:
+            self.assertIsNone(self.registry.dispatch("ping -h"))
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(self.handlers.calls, [])
+
+    def test_async_handler(self):
+        self.assertEqual(self.registry.dispatch("wait"), "done")
+        self.assertEqual(self.registry.dispatch("wait"), "done")
+
+    def test_register_function(self):
+        calls = []
+        self.registry.register("echo", lambda args: calls.append(args.words), [(("words",), {"nargs": "*"})])
+        self.registry.dispatch("echo a b")
+        self.assertEqual(calls, [["a", "b"]])
+
+    def test_load_plugins(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        with open(os.path.join(directory, "hello.py"), "w") as plugin:
+            plugin.write(
+                "def register(registry, owner):\n"
+                "    registry.register('hello', lambda: owner.calls.append(('hello',)))\n"
+            )
+        with open(os.path.join(directory, "_private.py"), "w") as plugin:
+            plugin.write("raise RuntimeError('should not be imported')\n")
+        self.assertEqual(self.registry.loadPlugins(directory, self.handlers), ["hello"])
+        self.registry.dispatch("hello")
+        self.assertEqual(self.handlers.calls, [("hello",)])
+        self.assertEqual(self.registry.loadPlugins(None, self.handlers), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,19 +1,22 @@
 import unittest
-import threading
+import subprocess
+import tempfile
+import shutil
 import socket
-import time
+import ssl
 import sys
+import os
 from io import StringIO
-from Server import Server, Client, Logger
+from Server import ServerManager, Client, Logger, createServerContext
+from Tracing import tracer
+from TestHarness import ServerTestCase, FakeAgent
 import tracemalloc
 
 tracemalloc.start()
 
-class TestServer(unittest.TestCase):
+class TestServer(ServerTestCase):
     def setUp(self):
-        self.server = Server("127.0.0.1", 8080)
-        self.server.refreshActiveClients = lambda: None
-        self.server.Thread.setDaemon(True)
+        super().setUp()
         self.logger = Logger()
         self.logger.BLUE = ""
         self.logger.GREEN = ""
@@ -22,78 +25,192 @@ class TestServer(unittest.TestCase):
         self.logger.WHITE = ""
 
     def test_start_server(self):
-        self.server.startServer()
         self.assertTrue(self.server.isServerRunning)
+        self.assertNotEqual(self.server.port, 0)
 
     def test_stop_server(self):
-        self.server.startServer()
+        agent = self.connect("test")
         self.server.stopServer()
         self.assertFalse(self.server.isServerRunning)
+        self.assertFalse(self.server.isThreadRunning)
+        self.assertFalse(self.server.Thread.is_alive())
+        self.assertEqual(agent.recv(), "stop")
+        self.assertIsNone(agent.recv())
+
+    def test_register_after_stop_closes_client(self):
+        self.server.stopServer()
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listener.close)
+        peer = socket.create_connection(listener.getsockname(), 5)
+        self.addCleanup(peer.close)
+        sock, _ = listener.accept()
+        peer.sendall(b"late\n")
+        self.server.registerClient(sock, ("127.0.0.1", 0))
+        self.assertEqual(self.server.clients, [])
+        self.assertEqual(sock.fileno(), -1)
+        self.assertEqual(peer.recv(1024), b"")
+
+    def test_accept_after_pool_shutdown_closes_client(self):
+        self.server.handshakePool.shutdown()
+        sock = socket.create_connection(("127.0.0.1", self.server.port), 5)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.recv(1024), b"")
+        self.assertTrue(self.server.Thread.is_alive())
+        self.assertEqual(self.server.clients, [])
 
     def test_accept_clients(self):
-        self.server.startServer()
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect(("127.0.0.1", 8080))
-        self.client.send("test".encode("utf-8"))
-        time.sleep(1)
+        self.connect("test")
         self.assertEqual(len(self.server.clients), 1)
-        self.server.stopServer()
+        self.assertEqual(self.server.clients[0].name, "test")
+
+    def test_wait_for_clients_timeout(self):
+        self.assertFalse(self.server.waitForClients(1, timeout=0.01))
+
+    def test_register_timeout(self):
+        self.startServer(registerTimeout=0.05)
+        sock = socket.create_connection(("127.0.0.1", self.server.port), 5)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.recv(1024), b"Request Timed out")
+        self.assertEqual(sock.recv(1024), b"")
+        self.assertEqual(len(self.server.clients), 0)
+
+    def test_register_timeout_closes_client_when_reply_fails(self):
+        self.startServer(registerTimeout=0.05)
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listener.close)
+        peer = socket.create_connection(listener.getsockname(), 5)
+        self.addCleanup(peer.close)
+        sock, _ = listener.accept()
+        # Writing the timeout reply fails with a broken pipe
+        sock.shutdown(socket.SHUT_WR)
+        self.server.registerClient(sock, ("127.0.0.1", 0))
+        self.assertEqual(sock.fileno(), -1)
+        self.assertEqual(self.server.clients, [])
+
+    def test_idle_connections_do_not_block_registration(self):
+        self.startServer(handshakeWorkers=1, registerTimeout=0.1)
+        idle = socket.create_connection(("127.0.0.1", self.server.port), 5)
+        self.addCleanup(idle.close)
+        self.connect("test")
+        self.assertEqual(idle.recv(1024), b"Request Timed out")
 
     def test_get_client_by_ip(self):
-        self.server.startServer()
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect(("127.0.0.1", 8080))
-        self.client.send("test".encode("utf-8"))
-        time.sleep(1)
+        self.connect("test")
         client = self.server.getClientByIp("127.0.0.1")
         self.assertIsInstance(client, Client)
-        self.server.stopServer()
 
     def test_get_client_by_name(self):
-        self.server.startServer()
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect(("127.0.0.1", 8080))
-        self.client.send("test".encode("utf-8"))
-        time.sleep(1)
+        self.connect("test")
         client = self.server.getClientByName("test")
         self.assertIsInstance(client, Client)
-        self.server.stopServer()
+        self.assertIsNone(self.server.getClientByName("missing"))
 
     def test_send_to_all(self):
-        self.server.startServer()
-        self.client1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client1.connect(("127.0.0.1", 8080))
-        self.client1.send("test1".encode("utf-8"))
-        self.client2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client2.connect(("127.0.0.1", 8080))
-        self.client2.send("test2".encode("utf-8"))
-        time.sleep(1)
+        client1 = self.connect("test1")
+        client2 = self.connect("test2")
         self.server.sendToAll("test")
-        data1 = self.client1.recv(1024).decode("utf-8")
-        data2 = self.client2.recv(1024).decode("utf-8")
-        self.assertEqual(data1, "test")
-        self.assertEqual(data2, "test")
-        self.server.stopServer()
+        self.assertEqual(client1.recvLine(), "conntest")
+        self.assertEqual(client1.recvLine(), "test")
+        self.assertEqual(client2.recvLine(), "conntest")
+        self.assertEqual(client2.recvLine(), "test")
 
     def test_kick_ip(self):
-        self.server.startServer()
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect(("127.0.0.1", 8080))
-        self.client.send("test".encode("utf-8"))
-        time.sleep(1)
+        agent = self.connect("test")
         self.server.kickIp("127.0.0.1")
         self.assertEqual(len(self.server.clients), 0)
-        self.server.stopServer()
+        self.assertEqual(agent.recv(), "kick")
+        self.assertIsNone(agent.recv())
+
+    def test_agent_stops_on_kick(self):
+        agent = self.startAgent("test")
+        thread = self.realAgents[-1][1]
+        self.server.kickClient(self.server.clients[0])
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(agent.running)
+
+    def test_agent_reconnects_after_disconnect(self):
+        self.startAgent("test", reconnectDelay=0.01)
+        thread = self.realAgents[-1][1]
+        self.dropClient()
+        self.assertTrue(self.server.waitForClients(1, timeout=5))
+        self.assertEqual(self.server.clients[0].name, "test")
+        self.assertTrue(thread.is_alive())
+
+    def test_agent_gives_up_reconnecting(self):
+        agent = self.startAgent("test", reconnectDelay=0.001, reconnectAttempts=3)
+        thread = self.realAgents[-1][1]
+        closed = socket.create_server(("127.0.0.1", 0))
+        agent.client.address = closed.getsockname()
+        closed.close()
+        self.dropClient()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(agent.running)
 
     def test_refresh_active_clients(self):
-        self.server.startServer()
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect(("127.0.0.1", 8080))
-        self.client.send("test".encode("utf-8"))
-        time.sleep(1)
+        agent = self.connect("test")
         self.server.refreshActiveClients()
         self.assertEqual(len(self.server.clients), 1)
-        self.server.stopServer()
+        self.assertEqual(agent.recvLine(), "conntest")
+
+    def test_heartbeat_interval(self):
+        self.startServer(clock=self.clock, heartbeatInterval=30)
+        agent = self.connect("test")
+        client = self.server.clients[0]
+        self.server.refreshActiveClients()
+        client.send("marker")
+        # The client was registered at the current time, so it is not tested again yet
+        self.assertEqual(agent.recvLine(), "marker")
+        self.clock.advance(31)
+        self.server.refreshActiveClients()
+        self.server.refreshActiveClients()
+        client.send("marker")
+        self.assertEqual(agent.recvLine(), "conntest")
+        self.assertEqual(agent.recvLine(), "marker")
+        self.assertEqual(client.lastTested, 31)
+
+    def test_manager_heartbeat_interval(self):
+        manager = ServerManager("127.0.0.1", 0, heartbeatInterval=30)
+        self.assertEqual(manager.server.heartbeatInterval, 30)
+
+    def test_ping_client(self):
+        self.startAgent("test")
+        manager = ServerManager("127.0.0.1", 0)
+        tracer.enabled = True
+        self.addCleanup(setattr, tracer, "enabled", False)
+        tracer.start("ping -n test")
+        sys.stdout = StringIO()
+        try:
+            manager.pingClient(self.server.clients[0])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = sys.__stdout__
+        tracer.finish()
+        self.assertIn("Client -> Server -> Client:", output)
+        stages = [stage for stage, _ in tracer.traces[-1].breakdown()]
+        self.assertEqual(stages, ["send", "agent_lookup", "agent_parse", "agent_send", "recv", "done"])
+
+    def test_ping_all_keeps_agent_time_per_reply(self):
+        self.startAgent("test1")
+        self.startAgent("test2")
+        manager = ServerManager("127.0.0.1", 0)
+        tracer.enabled = True
+        self.addCleanup(setattr, tracer, "enabled", False)
+        tracer.start("ping -a")
+        sys.stdout = StringIO()
+        try:
+            for client in list(self.server.clients):
+                manager.pingClient(client)
+        finally:
+            sys.stdout = sys.__stdout__
+        tracer.finish()
+        trace = tracer.traces[-1]
+        breakdown = trace.breakdown()
+        stages = [stage for stage, _ in breakdown]
+        self.assertEqual(stages, ["send", "agent_lookup", "agent_parse", "agent_send", "recv"] * 2 + ["done"])
+        self.assertTrue(all(ns >= 0 for _, ns in breakdown), breakdown)
+        self.assertEqual([len(remote) for stage, _, remote in trace.stages if stage == "recv"], [3, 3])
 
     def test_logger(self):
         capturedOutput = StringIO()
@@ -108,5 +225,145 @@ class TestServer(unittest.TestCase):
         self.assertEqual(capturedOutput.getvalue().strip(), "[INFO] test\n[WARNING] test\n[ERROR] test\n[SUCCESS] test")
         sys.stdout = sys.__stdout__
 
+class TestServerScale(ServerTestCase):
+    agentCount = 300
+
+    def test_many_clients(self):
+        agents = [FakeAgent(self.server.port, "agent{}".format(i)) for i in range(self.agentCount)]
+        self.agents.extend(agents)
+        self.assertTrue(self.server.waitForClients(self.agentCount, timeout=10))
+        self.assertEqual({client.name for client in self.server.clients}, {agent.name for agent in agents})
+        self.server.sendToAll("hello")
+        for agent in agents:
+            self.assertEqual(agent.recv(), "hello")
+        kicked = set()
+        for client in list(self.server.clients)[::2]:
+            self.server.kickClient(client)
+            kicked.add(client.name)
+        self.assertEqual(len(self.server.clients), self.agentCount // 2)
+        self.server.stopServer()
+        for agent in agents:
+            self.assertEqual(agent.recv(), "kick" if agent.name in kicked else "stop")
+            self.assertIsNone(agent.recv())
+
+class TestClientFraming(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.settimeout(5)
+        self.client = Client(self.sock, ("127.0.0.1", 0), "test")
+        self.addCleanup(self.sock.close)
+        self.addCleanup(self.peer.close)
+
+    def test_send_frames_messages(self):
+        self.client.send("conntest")
+        self.client.send("ping 1", 42)
+        self.assertEqual(self.peer.recv(1024), b"conntest\n#42 ping 1\n")
+
+    def test_recv_splits_and_joins_messages(self):
+        self.peer.send(b"first\nsec")
+        self.assertEqual(self.client.recv(), "first")
+        self.peer.send(b"ond\n")
+        self.assertEqual(self.client.recv(), "second")
+        self.peer.close()
+        self.assertEqual(self.client.recv(), "")
+
+    def test_recv_attaches_agent_timings(self):
+        tracer.enabled = True
+        self.addCleanup(setattr, tracer, "enabled", False)
+        trace = tracer.start("ping -a")
+        self.addCleanup(tracer.discard)
+        self.peer.send("#{}:send=1000 ping 1 2\n#999:send=5 stale\n".format(trace.traceId).encode())
+        self.assertEqual(self.client.recv(), "ping 1 2")
+        self.assertEqual(self.client.recv(), "stale")
+        self.assertEqual([(stage, remote) for stage, _, remote in trace.stages], [("input", []), ("recv", [("send", 1000)])])
+
+
+def makeCertificates(directory):
+    """
+    Generates a self-signed CA plus a server and a client certificate signed by it.
+    """
+    def openssl(*args):
+        subprocess.run(["openssl", *args], cwd=directory, check=True, capture_output=True)
+
+    openssl("req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-subj", "/CN=Test CA", "-keyout", "ca.key", "-out", "ca.pem")
+    with open(os.path.join(directory, "server.ext"), "w") as ext:
+        ext.write("subjectAltName=DNS:localhost,IP:127.0.0.1\n")
+    for name in ("server", "client"):
+        openssl("req", "-new", "-newkey", "rsa:2048", "-nodes",
+                "-subj", "/CN=" + name, "-keyout", name + ".key", "-out", name + ".csr")
+        extra = ["-extfile", "server.ext"] if name == "server" else []
+        openssl("x509", "-req", "-in", name + ".csr", "-CA", "ca.pem", "-CAkey", "ca.key",
+                "-CAcreateserial", "-days", "1", "-out", name + ".pem", *extra)
+
+
+@unittest.skipIf(shutil.which("openssl") is None, "openssl not available")
+class TestServerTLS(ServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.certDir = tempfile.mkdtemp()
+        makeCertificates(cls.certDir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.certDir, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.certDir, name)
+
+    def startTLSServer(self, mutual=False):
+        context = createServerContext(self.path("server.pem"), self.path("server.key"),
+                                      self.path("ca.pem") if mutual else None)
+        self.startServer(sslContext=context)
+
+    def clientContext(self, withCert=False):
+        context = ssl.create_default_context(cafile=self.path("ca.pem"))
+        if withCert:
+            context.load_cert_chain(self.path("client.pem"), self.path("client.key"))
+        return context
+
+    def test_tls_client_registers(self):
+        self.startTLSServer()
+        agent = self.connect("secure", sslContext=self.clientContext())
+        self.server.clients[0].send("hello")
+        self.assertEqual(agent.recvLine(), "hello")
+        self.assertEqual(self.server.getClientByName("secure").name, "secure")
+
+    def test_mutual_auth_requires_client_certificate(self):
+        self.startTLSServer(mutual=True)
+        with self.assertRaises((ssl.SSLError, OSError)):
+            # TLS 1.3 reports the rejected certificate after the handshake, on the next read or write
+            agent = FakeAgent(self.server.port, "anonymous", self.clientContext())
+            self.addCleanup(agent.close)
+            agent.recvLine()
+        self.connect("trusted", sslContext=self.clientContext(withCert=True))
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual(self.server.clients[0].name, "trusted")
+
+    def test_session_resumption(self):
+        self.startTLSServer(mutual=True)
+        context = self.clientContext(withCert=True)
+        first = self.connect("agent", sslContext=context)
+        self.server.clients[0].send("hello")
+        first.recvLine()
+        self.assertFalse(first.sock.session_reused)
+        second = self.connect("agent", sslContext=context, session=first.sock.session)
+        self.assertTrue(second.sock.session_reused)
+
+    def test_agent_resumes_session_on_reconnect(self):
+        self.startTLSServer(mutual=True)
+        self.startAgent("agent", sslContext=self.clientContext(withCert=True), reconnectDelay=0.01)
+        # A round trip makes sure the agent has read the session tickets
+        sys.stdout = StringIO()
+        try:
+            ServerManager("127.0.0.1", 0).pingClient(self.server.clients[0])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertFalse(self.server.clients[0].client.session_reused)
+        self.dropClient()
+        self.assertTrue(self.server.waitForClients(1, timeout=5))
+        self.assertTrue(self.server.clients[0].client.session_reused)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import threading
+from Tracing import Tracer, Trace, tagMessage, splitTag, percentile
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.tracer = Tracer(capacity=4)
+        self.tracer.enabled = True
+
+    def test_tag_round_trip(self):
+        self.assertEqual(splitTag("ping 1"), (None, [], "ping 1"))
+        self.assertEqual(splitTag(tagMessage("ping 1", 7)), (7, [], "ping 1"))
+        tagged = tagMessage("ping 1 2", 7, [("lookup", 10), ("send", 250)])
+        self.assertEqual(tagged, "#7:lookup=10,send=250 ping 1 2")
+        self.assertEqual(splitTag(tagged), (7, [("lookup", 10), ("send", 250)], "ping 1 2"))
+
+    def test_disabled_tracer_does_not_trace(self):
+        self.tracer.enabled = False
+        self.assertIsNone(self.tracer.start("ping -a"))
+        self.tracer.mark("lookup")
+        self.tracer.finish()
+        self.assertEqual(len(self.tracer.traces), 0)
+
+    def test_trace_is_per_thread(self):
+        trace = self.tracer.start("ping -a")
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.tracer.current()))
+        thread.start()
+        thread.join()
+        self.assertIs(self.tracer.current(), trace)
+        self.assertEqual(other, [None])
+
+    def test_breakdown_subtracts_agent_time(self):
+        trace = Trace(1, "ping", "input")
+        trace.stages = [("input", 0, []), ("lookup", 100, []), ("send", 300, []),
+                        ("recv", 1300, [("parse", 200), ("send", 300)]), ("done", 1400, [])]
+        self.assertEqual(trace.breakdown(), [
+            ("lookup", 100), ("send", 200), ("agent_parse", 200), ("agent_send", 300), ("recv", 500), ("done", 100),
+        ])
+        self.assertEqual(trace.total(), 1400)
+
+    def test_breakdown_keeps_agent_time_per_reply(self):
+        trace = Trace(1, "ping", "input")
+        trace.stages = [("input", 0, []), ("send", 100, []), ("recv", 400, [("send", 100)]),
+                        ("send", 500, []), ("recv", 1600, [("send", 900)]), ("done", 1700, [])]
+        self.assertEqual(trace.breakdown(), [
+            ("send", 100), ("agent_send", 100), ("recv", 200),
+            ("send", 100), ("agent_send", 900), ("recv", 200), ("done", 100),
+        ])
+
+    def test_ring_buffer(self):
+        for i in range(6):
+            self.tracer.start("ping {}".format(i))
+            self.tracer.finish()
+        self.assertEqual([trace.traceId for trace in self.tracer.traces], [3, 4, 5, 6])
+        self.assertIsNone(self.tracer.current())
+
+    def test_discard(self):
+        self.tracer.start("trace show")
+        self.tracer.discard()
+        self.tracer.finish()
+        self.assertEqual(len(self.tracer.traces), 0)
+
+    def test_summary(self):
+        for command in ("kick", "ping", "ping"):
+            self.tracer.start(command)
+            self.tracer.mark("refresh")
+            self.tracer.mark("refresh")
+            self.tracer.finish()
+        stages = self.tracer.summary("ping")
+        self.assertEqual(list(stages), ["refresh", "done", "total"])
+        self.assertEqual(len(stages["refresh"]), 2)
+        self.assertEqual(stages["refresh"], sorted(stages["refresh"]))
+        self.assertEqual(len(self.tracer.summary()["total"]), 3)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([5], 90), 5)
+        self.assertEqual(percentile([], 50), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()